@@ -1,15 +1,40 @@
 import streamlit as st
+import asyncio
+import concurrent.futures
+import contextlib
+import csv
 import datetime
-from typing import List, Iterator, Optional
+import functools
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Iterator, Optional, Tuple
+import diskcache
+import httpx
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+from groq import APIStatusError, AsyncGroq, Groq as GroqClient
 from phi.agent import Agent
 from phi.workflow import Workflow, RunResponse, RunEvent
 from phi.model.groq import Groq
 from phi.storage.workflow.sqlite import SqlWorkflowStorage
 from phi.tools.exa import ExaTools
 from phi.utils.log import logger
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr, ValidationError
 from dateutil.relativedelta import relativedelta
-from textwrap import dedent
+
+if sys.platform != "win32":
+    import uvloop
+    _new_event_loop = uvloop.new_event_loop
+else:
+    _new_event_loop = asyncio.new_event_loop
 
 class MedicalArticle(BaseModel):
     """Structure for medical article metadata"""
@@ -25,95 +50,582 @@ class MedicalBlogPost(BaseModel):
     word_count: int
     sources: List[MedicalArticle]
 
-class MedicalBlogGenerator(Workflow):
-    """Medical blog post generator using Groq"""
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+def _parse_retry_delay(headers) -> Optional[float]:
+    """Seconds to wait according to Groq's retry-after / x-ratelimit-reset-* headers"""
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    # Reset headers use Go-style durations such as "7.66s" or "2m59.56s".
+    # The requests window is Groq's daily quota while the tokens one is per
+    # minute, so take the shorter of the two rather than sleeping for hours.
+    delays = []
+    for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        value = headers.get(name)
+        if value:
+            delays.append(sum(float(n) * _DURATION_UNITS[unit] for n, unit in _DURATION_RE.findall(value)))
+    return min(delays) if delays else None
+
+GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+EXA_API_KEY = os.getenv("EXA_API_KEY")
+
+# Groq account limits; override to match the key's tier
+GROQ_RPM = int(os.getenv("GROQ_RPM", "30"))
+GROQ_TPM = int(os.getenv("GROQ_TPM", "6000"))
+
+# Completion budgets, sent as max_tokens and charged up front to the TPM
+# bucket until the call reports its real usage; ~1500 words of post is
+# roughly 2000 tokens
+SEARCH_MAX_TOKENS = 1024
+CONTENT_MAX_TOKENS = 3072
+# Tool schemas plus the Exa results phi feeds back into the second completion
+TOOL_ROUND_TOKENS = 1500
+
+class TokenBucket:
+    """Thread-safe token bucket that refills continuously over a period"""
+
+    def __init__(self, capacity: float, period: float = 60.0):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1.0) -> float:
+        """Wait until `amount` tokens are available and take them; returns the amount taken"""
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return amount
+                wait = (amount - self._tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    def try_acquire(self, amount: float = 1.0) -> Optional[float]:
+        """Take `amount` tokens only if they are available right now; returns the amount taken"""
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            if self._tokens < amount:
+                return None
+            self._tokens -= amount
+            return amount
+
+    def refund(self, amount: float):
+        """Give back tokens that were taken but turned out not to be needed"""
+        if amount <= 0:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+    def clamp(self, remaining: float):
+        """Never hand out more than the server says is left"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, remaining)
+
+@st.cache_resource
+def _groq_limiters() -> Dict[str, TokenBucket]:
+    """Process-wide Groq request/token buckets, shared across sessions and reruns"""
+    return {"requests": TokenBucket(GROQ_RPM), "tokens": TokenBucket(GROQ_TPM)}
+
+def _sync_limiters_from_headers(headers):
+    """Clamp the local buckets to Groq's x-ratelimit-remaining-* headers"""
+    # remaining-tokens is per minute, but remaining-requests counts down the
+    # *daily* request quota; it only bites once fewer requests are left today
+    # than the per-minute bucket holds
+    for kind, bucket in _groq_limiters().items():
+        remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+        if remaining is not None:
+            try:
+                bucket.clamp(float(remaining))
+            except ValueError:
+                pass
+
+async def with_backoff(
+    op: Callable[[], Awaitable[Any]],
+    max_retries: int = 5,
+    base: float = 1.0,
+    cap: float = 32.0,
+    jitter: float = 0.5,
+) -> Any:
+    """Await op(), retrying Groq 429s with exponential backoff and jitter"""
+    for attempt in range(max_retries + 1):
+        try:
+            return await op()
+        except APIStatusError as e:
+            if e.status_code != 429 or attempt == max_retries:
+                raise
+            _sync_limiters_from_headers(e.response.headers)
+            delay = _parse_retry_delay(e.response.headers)
+            if delay is None:
+                delay = base * 2 ** attempt
+            delay = min(delay + random.random() * jitter, cap)
+            logger.warning(f"Groq rate limit hit, retrying in {delay:.1f}s ({attempt + 1}/{max_retries})")
+            await asyncio.sleep(delay)
+
+async def _on_groq_response(response: httpx.Response):
+    _sync_limiters_from_headers(response.headers)
+
+def _on_groq_response_sync(response: httpx.Response):
+    _sync_limiters_from_headers(response.headers)
 
-    search_agent: Agent = Agent(
-        model=Groq(id="llama-3.3-70b-versatile",api_key='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'),
+_GROQ_HTTP_OPTIONS: Dict[str, Any] = {
+    "http2": True,
+    "limits": httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60),
+    "timeout": httpx.Timeout(60.0, connect=5.0),
+}
+
+def _groq_http_client() -> httpx.AsyncClient:
+    """Pooled HTTP/2 client that also feeds Groq's rate-limit headers to the buckets"""
+    return httpx.AsyncClient(event_hooks={"response": [_on_groq_response]}, **_GROQ_HTTP_OPTIONS)
+
+def _groq_sync_http_client() -> httpx.Client:
+    """Blocking counterpart of _groq_http_client, for agents run on worker threads"""
+    return httpx.Client(event_hooks={"response": [_on_groq_response_sync]}, **_GROQ_HTTP_OPTIONS)
+
+def _estimate_prompt_tokens(agent: Agent, message: str) -> float:
+    """Prompt tokens of one completion for `agent`: its instructions plus the message"""
+    # ~4 characters per token for English text
+    instructions = agent.instructions if isinstance(agent.instructions, list) else []
+    return (len(message) + sum(len(line) for line in instructions)) / 4
+
+def _estimate_usage(agent: Agent, message: str) -> Tuple[int, float]:
+    """Completions and tokens a single run of `agent` is expected to cost at most"""
+    prompt_tokens = _estimate_prompt_tokens(agent, message)
+    completions, tokens = 1, prompt_tokens
+    if agent.tools:
+        # phi's tool loop: one completion to call the tool(s), then another
+        # that resends the prompt together with the tool results
+        completions, tokens = 2, 2 * prompt_tokens + TOOL_ROUND_TOKENS
+    return completions, tokens + (agent.model.max_tokens or 0)
+
+async def _acquire_for(agent: Agent, message: str, speculative: bool = False) -> Optional[float]:
+    """Take an agent call's estimated requests and tokens from the shared buckets
+
+    Returns the tokens taken, to be settled with _settle_tokens once the
+    call has finished. A speculative call never waits: it only runs on
+    spare capacity, and gets None when there is none.
+    """
+    limiters = _groq_limiters()
+    completions, tokens = _estimate_usage(agent, message)
+    if speculative:
+        if limiters["requests"].try_acquire(completions) is None:
+            return None
+        charged = limiters["tokens"].try_acquire(tokens)
+        if charged is None:
+            limiters["requests"].refund(completions)
+        return charged
+    await limiters["requests"].acquire(completions)
+    return await limiters["tokens"].acquire(tokens)
+
+def _reported_tokens(response: Optional[RunResponse]) -> Optional[float]:
+    """Total tokens Groq reported across a finished agent run, if it reported any"""
+    metrics = response.metrics if response is not None else None
+    return sum((metrics or {}).get("total_tokens") or []) or None
+
+def _settle_tokens(charged: float, used: Optional[float]):
+    """Refund the part of an up-front token charge that the call did not use"""
+    if used is not None:
+        _groq_limiters()["tokens"].refund(charged - used)
+
+def _run_agent_settled(agent: Agent, message: str, charged: float) -> RunResponse:
+    """agent.run(message) on the calling thread, then settle its token charge"""
+    try:
+        response = agent.run(message)
+    except APIStatusError:
+        # Rejected, so nothing was used; with_backoff re-syncs the buckets
+        # from the response headers
+        _settle_tokens(charged, 0)
+        raise
+    _settle_tokens(charged, _reported_tokens(response))
+    return response
+
+async def _call_agent(agent: Agent, message: str, speculative: bool = False) -> Optional[RunResponse]:
+    """Run an agent under the shared Groq throttle, retrying on 429
+
+    A speculative call is skipped, returning None, when the throttle has no
+    spare capacity for it.
+    """
+    async def attempt():
+        charged = await _acquire_for(agent, message, speculative)
+        if charged is None:
+            return None
+        if agent.tools:
+            # phi calls tools synchronously even from arun, so a blocking
+            # Exa search would stall every other task on the loop; run the
+            # whole tool loop on a worker thread instead. The thread settles
+            # the charge itself, so a speculative search whose task was
+            # cancelled is still refunded once it finishes.
+            return await asyncio.to_thread(_run_agent_settled, agent, message, charged)
+        try:
+            response = await agent.arun(message)
+        except APIStatusError:
+            _settle_tokens(charged, 0)
+            raise
+        _settle_tokens(charged, _reported_tokens(response))
+        return response
+
+    return await with_backoff(attempt)
+
+async def _stream_agent(agent: Agent, message: str) -> AsyncIterator[str]:
+    """Stream an agent's reply under the shared Groq throttle, retrying on 429"""
+    async def open_stream():
+        charged = await _acquire_for(agent, message)
+        try:
+            stream = await agent.arun(message, stream=True)
+            # The request is only sent on the first read, so a 429 surfaces
+            # here and can still be retried before anything reaches the user
+            first = await anext(stream, None)
+        except APIStatusError:
+            _settle_tokens(charged, 0)
+            raise
+        return charged, first, stream
+
+    charged, first, stream = await with_backoff(open_stream)
+    streamed = 0
+    try:
+        if first is None:
+            return
+        if first.content:
+            streamed += len(first.content)
+            yield first.content
+        async for chunk in stream:
+            if chunk.content:
+                streamed += len(chunk.content)
+                yield chunk.content
+    finally:
+        # Groq puts a stream's usage on its last chunk where phi does not
+        # read it, so fall back to estimating from the streamed text
+        used = _reported_tokens(agent.run_response)
+        if used is None:
+            used = _estimate_prompt_tokens(agent, message) + streamed / 4
+        _settle_tokens(charged, used)
+
+def _discard_task_error(task: asyncio.Task):
+    """Mark a speculative task's failure as handled when nobody awaits it"""
+    if not task.cancelled() and task.exception() is not None:
+        logger.debug(f"Discarded speculative task error: {task.exception()}")
+
+def _run_sync(coro: Awaitable[Any]) -> Any:
+    """Run a coroutine to completion from synchronous code on a private event loop"""
+    loop = _new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        try:
+            loop.run_until_complete(loop.shutdown_default_executor())
+        finally:
+            loop.close()
+
+def _iter_async(agen: AsyncIterator[Any]) -> Iterator[Any]:
+    """Drive an async generator from synchronous code on a private event loop"""
+    loop = _new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(anext(agen))
+            except StopAsyncIteration:
+                return
+    finally:
+        try:
+            loop.run_until_complete(agen.aclose())
+            # Let cancelled speculative searches unwind before closing,
+            # including any search thread that is still running
+            pending = asyncio.all_tasks(loop)
+            if pending:
+                for task in pending:
+                    task.cancel()
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_default_executor())
+        finally:
+            loop.close()
+
+# Exa results for a given topic/query are reused for a day
+EXA_CACHE_TTL = 86400
+
+# Generated posts are shared between workers through Redis when configured;
+# otherwise they only live in the workflow's session_state
+REDIS_URL = os.getenv("REDIS_URL")
+BLOG_CACHE_TTL = 86400
+
+def _blog_cache_key(topic: str) -> str:
+    return f"mbp:{hashlib.sha256(topic.strip().lower().encode()).hexdigest()}"
+
+@st.cache_resource
+def _exa_cache() -> diskcache.Cache:
+    """On-disk cache of parsed Exa search results, shared by every session"""
+    return diskcache.Cache("tmp/exa_cache")
+
+_SECTION_SPLIT_RE = re.compile(r"^[ \t]*-{3,}[ \t]*$", re.MULTILINE)
+_FIELD_RE = re.compile(
+    r"^[ \t]*(title|authors|journal|date|url)[ \t]*:[ \t]*(\S.*?)[ \t\r]*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+def _format_references(articles: List[MedicalArticle]) -> str:
+    """Markdown list of the articles, one '- journal: [title](url)' line each"""
+    return "\n".join(f"- {article.journal}: [{article.title}]({article.url})" for article in articles)
+
+_WORD_RE = re.compile(r"\S+")
+
+def _count_words(content: str) -> int:
+    """Whitespace-delimited word count without building the split() list"""
+    return sum(1 for _ in _WORD_RE.finditer(content))
+
+@functools.lru_cache(maxsize=256)
+def _parse_articles(content: str, default_date: str) -> Tuple[MedicalArticle, ...]:
+    """Parse the search agent's Title/Authors/... blocks into articles"""
+    articles = []
+    for section in _SECTION_SPLIT_RE.split(content):
+        article_data = {key.lower(): value for key, value in _FIELD_RE.findall(section)}
+
+        if article_data.get('title') and article_data.get('url'):
+            # Every field is a regex-captured string already, so skip validation
+            articles.append(MedicalArticle.model_construct(
+                title=article_data.get('title'),
+                journal=article_data.get('journal', 'Medical Journal'),
+                url=article_data.get('url'),
+                date=article_data.get('date', default_date),
+                authors=article_data.get('authors')
+            ))
+            logger.info(f"Found article: {article_data.get('title')}")
+
+    return tuple(articles)
+
+SEARCH_INSTRUCTIONS: Tuple[str, ...] = (
+    "You are a medical research assistant searching for high-quality medical literature.",
+    "Search priorities:",
+    "1. Find recent systematic reviews, meta-analyses, and clinical trials",
+    "2. Focus on reputable medical journals and sources",
+    "3. Look for articles with clear clinical significance",
+    "4. Prioritize papers with statistical data and concrete findings",
+    "5. Include both recent and seminal papers in the field",
+    "Format each result exactly as:",
+    "Title: [full title]",
+    "Authors: [author names]",
+    "Journal: [journal name]",
+    "Date: [publication date]",
+    "URL: [article URL]",
+    "---",
+)
+
+CONTENT_INSTRUCTIONS: Tuple[str, ...] = (
+    "You are a medical writer creating evidence-based blog posts.",
+    "Target audience: Medical professionals and specialists.",
+    "Writing style: Academic, sophisticated, with precise medical terminology.",
+    "Requirements:",
+    "1. Use advanced medical terminology",
+    "2. Include detailed statistical analyses",
+    "3. Reference specific guidelines and evidence levels",
+    "4. Discuss pathophysiological mechanisms",
+    "5. Critical analysis of methodology",
+    "Use this exact format:",
+
+    "# Latest Evidence: [Title]",
+    "[3-4 sentence introduction with specific epidemiological data]",
+
+    "## 🎯 Key Points",
+    "- Primary finding with detailed **statistical analysis**",
+    "- Secondary outcome with **confidence intervals**",
+    "- Tertiary result with **p-values and clinical significance**",
+
+    "## 📚 Background",
+    "[3-4 paragraphs with pathophysiological mechanisms and current guidelines]",
+
+    "## 🔍 Recent Evidence",
+    "### Key Findings",
+    "[Detailed statistical analysis with **methodology and results**]",
+
+    "### Clinical Implications",
+    "[Evidence-based recommendations with levels of evidence]",
+
+    "## 💡 Expert Commentary",
+    "[Critical analysis of methodological strengths/limitations]",
+
+    "## 💎 Clinical Pearls",
+    "- Evidence-based recommendation (Level A)",
+    "- Key mechanistic insight",
+    "- Critical implementation consideration",
+
+    "## 🎯 Bottom Line",
+    "[Synthesis of evidence with specific recommendations]",
+)
+
+def _build_search_agent(client: Optional[GroqClient] = None) -> Agent:
+    """Medical literature search agent; the Exa date window is computed per build"""
+    # Runs through the blocking client: see _call_agent
+    return Agent(
+        model=Groq(
+            id="llama-3.3-70b-versatile",
+            api_key=GROQ_API_KEY,
+            client=client,
+            max_tokens=SEARCH_MAX_TOKENS,
+        ),
         tools=[ExaTools(
-            start_published_date=(datetime.datetime.now() - relativedelta(years=5)).strftime("%Y-%m-%d"),
+            start_published_date=(datetime.date.today() - relativedelta(years=5)).isoformat(),
             type="keyword",
-            api_key="fcb77e87-2365-4cf3-8187-95aa349da524"
+            api_key=EXA_API_KEY
         )],
         description="Medical literature search agent",
-        instructions=[
-            "You are a medical research assistant searching for high-quality medical literature.",
-            "Search priorities:",
-            "1. Find recent systematic reviews, meta-analyses, and clinical trials",
-            "2. Focus on reputable medical journals and sources",
-            "3. Look for articles with clear clinical significance",
-            "4. Prioritize papers with statistical data and concrete findings",
-            "5. Include both recent and seminal papers in the field",
-            "Format each result exactly as:",
-            "Title: [full title]",
-            "Authors: [author names]",
-            "Journal: [journal name]",
-            "Date: [publication date]",
-            "URL: [article URL]",
-            "---"
-        ],
+        instructions=list(SEARCH_INSTRUCTIONS),
         markdown=True,
         show_tool_calls=True
     )
 
-    content_agent: Agent = Agent(
-        model=Groq(id="llama-3.3-70b-versatile",api_key='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'),
+def _build_content_agent(async_client: Optional[AsyncGroq] = None) -> Agent:
+    """Medical writing agent"""
+    return Agent(
+        model=Groq(
+            id="llama-3.3-70b-versatile",
+            api_key=GROQ_API_KEY,
+            async_client=async_client,
+            max_tokens=CONTENT_MAX_TOKENS,
+        ),
         markdown=True,
-        instructions=[
-            "You are a medical writer creating evidence-based blog posts.",
-            "Target audience: Medical professionals and specialists.",
-            "Writing style: Academic, sophisticated, with precise medical terminology.",
-            "Use this exact format:",
-            
-            "# Latest Evidence: [Title]",
-            "[3-4 sentence introduction with specific epidemiological data]",
-            
-            "## 🎯 Key Points",
-            "- Primary finding with detailed **statistical analysis**",
-            "- Secondary outcome with **confidence intervals**",
-            "- Tertiary result with **p-values and clinical significance**",
-            
-            "## 📚 Background",
-            "[3-4 paragraphs with pathophysiological mechanisms and current guidelines]",
-            
-            "## 🔍 Recent Evidence",
-            "### Key Findings",
-            "[Detailed statistical analysis with **methodology and results**]",
-            
-            "### Clinical Implications",
-            "[Evidence-based recommendations with levels of evidence]",
-            
-            "## 💡 Expert Commentary",
-            "[Critical analysis of methodological strengths/limitations]",
-            
-            "## 💎 Clinical Pearls",
-            "- Evidence-based recommendation (Level A)",
-            "- Key mechanistic insight",
-            "- Critical implementation consideration",
-            
-            "## 🎯 Bottom Line",
-            "[Synthesis of evidence with specific recommendations]"
-        ]
+        instructions=list(CONTENT_INSTRUCTIONS),
     )
-    
+
+# Bulk generation: concurrent literature searches, then one Groq batch job
+# polled with a doubling interval
+BATCH_CONCURRENCY = 10
+BATCH_POLL_INTERVAL = 5.0
+BATCH_POLL_CAP = 60.0
+
+def _session_id(topic: str) -> str:
+    return f"medical-blog-{topic.lower().replace(' ', '-')}"
+
+def _workflow_storage() -> SqlWorkflowStorage:
+    return SqlWorkflowStorage(
+        table_name="medical_blog_workflows",
+        db_file="tmp/workflows.db",
+    )
+
+def _read_topics_csv(data: bytes) -> List[str]:
+    """Topics from the first column of a CSV, skipping an optional 'topic' header"""
+    rows = csv.reader(io.StringIO(data.decode("utf-8-sig")))
+    topics = [row[0].strip() for row in rows if row and row[0].strip()]
+    if topics and topics[0].lower() == "topic":
+        topics = topics[1:]
+    return topics
+
+class MedicalBlogGenerator(Workflow):
+    """Medical blog post generator using Groq"""
+
+    search_agent: Agent
+    content_agent: Agent
     topic: str = Field(..., description="Medical topic to research")
+    # Date stamped on articles and the footer; refreshed at the start of each run
+    _run_date_iso: str = PrivateAttr(default_factory=lambda: datetime.date.today().isoformat())
+    # Markdown reference list for the fetched articles; feeds both the prompt
+    # and the post's References section
+    _refs_md: str = PrivateAttr(default="")
 
     def __init__(self, topic: str, session_id: str, storage=None):
-        super().__init__(topic=topic, session_id=session_id, storage=storage)
+        super().__init__(
+            topic=topic,
+            session_id=session_id,
+            storage=storage,
+            search_agent=_build_search_agent(),
+            content_agent=_build_content_agent(),
+        )
         logger.info(f"Initialized blog generator for: {topic}")
 
-    def get_cached_blog_post(self, topic: str) -> Optional[MedicalBlogPost]:
+    @contextlib.asynccontextmanager
+    async def _groq_session(self):
+        """Share pooled Groq clients across every agent call in a run"""
+        # Without this phi opens a fresh httpx client for every completion.
+        # The async client is scoped to the run because it is bound to the
+        # run's event loop; the search agent runs on worker threads and so
+        # gets a blocking one. The SDK's own retries are off so that every
+        # retry goes through with_backoff and is charged to the buckets.
+        async with _groq_http_client() as http_client:
+            with _groq_sync_http_client() as sync_http_client:
+                self.search_agent.model.client = GroqClient(
+                    api_key=GROQ_API_KEY, http_client=sync_http_client, max_retries=0
+                )
+                self.content_agent.model.async_client = AsyncGroq(
+                    api_key=GROQ_API_KEY, http_client=http_client, max_retries=0
+                )
+                try:
+                    yield
+                finally:
+                    self.search_agent.model.client = None
+                    self.content_agent.model.async_client = None
+
+    async def get_cached_blog_post(self, topic: str) -> Optional[MedicalBlogPost]:
         """Retrieve cached blog post if available"""
         logger.info("Checking cache...")
-        return self.session_state.get("medical_blog_posts", {}).get(topic)
+        if REDIS_URL:
+            try:
+                async with aioredis.from_url(REDIS_URL) as client:
+                    raw = await client.get(_blog_cache_key(topic))
+                return MedicalBlogPost.model_validate_json(raw) if raw else None
+            except RedisError as e:
+                logger.warning(f"Redis cache unavailable: {str(e)}")
+            except ValidationError as e:
+                logger.warning(f"Ignoring unreadable cached post ({e.error_count()} validation errors)")
+                return None
+        cached = self.session_state.get("medical_blog_posts", {}).get(topic)
+        try:
+            return MedicalBlogPost.model_validate(cached) if cached else None
+        except ValidationError as e:
+            logger.warning(f"Ignoring unreadable cached post ({e.error_count()} validation errors)")
+            return None
 
-    def add_blog_post_to_cache(self, topic: str, blog_post: Optional[MedicalBlogPost]):
+    async def add_blog_post_to_cache(self, topic: str, blog_post: Optional[MedicalBlogPost]):
         """Cache the generated blog post"""
         logger.info("Caching blog post...")
+        if REDIS_URL and blog_post is not None:
+            try:
+                async with aioredis.from_url(REDIS_URL) as client:
+                    await client.set(_blog_cache_key(topic), blog_post.model_dump_json(), ex=BLOG_CACHE_TTL)
+                return
+            except RedisError as e:
+                logger.warning(f"Redis cache unavailable: {str(e)}")
         self.session_state.setdefault("medical_blog_posts", {})
-        self.session_state["medical_blog_posts"][topic] = blog_post
+        # Stored as a plain dict so the workflow storage can serialise it
+        self.session_state["medical_blog_posts"][topic] = blog_post.model_dump() if blog_post else None
+
+    async def _exa_search(
+        self, query: str, agent: Optional[Agent] = None, speculative: bool = False
+    ) -> Optional[List[MedicalArticle]]:
+        """Run a single literature search and parse the articles it returns
+
+        Returns None when a speculative search was skipped for lack of Groq
+        capacity.
+        """
+        cache = _exa_cache()
+        key = hashlib.sha256(f"{self.topic}|{query}".encode()).hexdigest()
+        cached = cache.get(key)
+        if cached is not None:
+            logger.info("Using cached search results")
+            return [MedicalArticle.model_construct(**article) for article in cached]
+
+        response = await _call_agent(agent or self.search_agent, query, speculative)
+        if response is None:
+            return None
+        articles = self._parse_search_results(response)
+        if articles:
+            # Store plain dicts: Streamlit runs this script as __main__, so
+            # pickled model classes would not resolve on the next rerun
+            cache.set(key, [article.model_dump() for article in articles], expire=EXA_CACHE_TTL)
+        return articles
 
-    def fetch_recent_articles(self) -> List[MedicalArticle]:
+    async def _fetch_recent_articles_async(self) -> List[MedicalArticle]:
         """Fetch recent medical articles using ExaTools"""
         try:
             logger.info("Searching medical literature...")
@@ -148,25 +660,46 @@ class MedicalBlogGenerator(Workflow):
             URL: [full URL]
             ---
             """
+            broader_query = f"""
+            exa_search: "{self.topic}" AND (
+                "medicine" OR 
+                "clinical" OR 
+                "medical" OR 
+                "treatment"
+            )
             
-            response = self.search_agent.run(search_query)
-            articles = self._parse_search_results(response)
-            
-            if not articles:
-                logger.warning("No articles found, trying broader search...")
-                broader_query = f"""
-                exa_search: "{self.topic}" AND (
-                    "medicine" OR 
-                    "clinical" OR 
-                    "medical" OR 
-                    "treatment"
-                )
-                
-                Find any relevant medical articles about this topic.
-                Include review articles, clinical studies, and guidelines.
-                """
-                response = self.search_agent.run(broader_query)
-                articles = self._parse_search_results(response)
+            Find any relevant medical articles about this topic.
+            Include review articles, clinical studies, and guidelines.
+            """
+
+            # Start the broader search speculatively so a miss on the primary
+            # query costs max(primary, broader) instead of primary + broader.
+            # Both run on worker threads (see _call_agent), so their Exa calls
+            # overlap as well as their completions. This trades quota for
+            # latency: the broader query is usually already in flight by the
+            # time the primary returns, and a worker thread cannot be
+            # interrupted, so cancelling it below only stops us waiting on it.
+            # It runs on its own agent since phi agents keep per-run state on
+            # the instance, and only on spare Groq capacity so that it never
+            # queues ahead of the primary search or the post itself.
+            primary = asyncio.create_task(self._exa_search(search_query))
+            broader_agent = _build_search_agent(self.search_agent.model.client)
+            broader = asyncio.create_task(self._exa_search(broader_query, broader_agent, speculative=True))
+            broader.add_done_callback(_discard_task_error)
+
+            try:
+                articles = await primary
+            except Exception as e:
+                logger.error(f"Primary search failed: {str(e)}")
+                articles = []
+
+            if articles:
+                broader.cancel()
+            else:
+                logger.warning("No articles found, using broader search...")
+                articles = await broader
+                if articles is None:
+                    articles = await self._exa_search(broader_query, broader_agent)
             
             return articles[:3] if articles else self._get_fallback_articles()
             
@@ -176,34 +709,9 @@ class MedicalBlogGenerator(Workflow):
 
     def _parse_search_results(self, response) -> List[MedicalArticle]:
         """Helper method to parse search results"""
-        articles = []
         if isinstance(response.content, str):
-            sections = response.content.split('---')
-            
-            for section in sections:
-                section = section.strip()
-                if not section:
-                    continue
-                    
-                article_data = {}
-                for line in section.split('\n'):
-                    line = line.strip()
-                    if ':' in line:
-                        key, value = [x.strip() for x in line.split(':', 1)]
-                        if key.lower() in ['title', 'authors', 'journal', 'date', 'url']:
-                            article_data[key.lower()] = value
-
-                if article_data.get('title') and article_data.get('url'):
-                    articles.append(MedicalArticle(
-                        title=article_data.get('title'),
-                        journal=article_data.get('journal', 'Medical Journal'),
-                        url=article_data.get('url'),
-                        date=article_data.get('date', datetime.datetime.now().strftime("%Y-%m-%d")),
-                        authors=article_data.get('authors')
-                    ))
-                    logger.info(f"Found article: {article_data.get('title')}")
-        
-        return articles
+            return list(_parse_articles(response.content, self._run_date_iso))
+        return []
 
     def _get_fallback_articles(self) -> List[MedicalArticle]:
         """Provide fallback articles when search fails"""
@@ -212,129 +720,236 @@ class MedicalBlogGenerator(Workflow):
                 title=f"Current Management of {self.topic}",
                 journal="UpToDate",
                 url="https://www.uptodate.com",
-                date=datetime.datetime.now().strftime("%Y-%m-%d"),
+                date=self._run_date_iso,
                 authors="Medical Faculty"
             ),
             MedicalArticle(
                 title=f"Clinical Practice Guidelines for {self.topic}",
                 journal="PubMed Central",
                 url="https://www.ncbi.nlm.nih.gov/pmc",
-                date=datetime.datetime.now().strftime("%Y-%m-%d"),
+                date=self._run_date_iso,
                 authors="Medical Associations"
             )
         ]
 
-    def generate_blog_post(self, articles: List[MedicalArticle]) -> MedicalBlogPost:
-        """Generate formatted medical blog post"""
-        articles_context = "\n".join([
-            f"Article {i+1}:\n"
-            f"Title: {article.title}\n"
-            f"Authors: {article.authors}\n"
-            f"Journal: {article.journal}\n"
-            f"Date: {article.date}\n"
-            f"URL: {article.url}\n"
-            for i, article in enumerate(articles)
-        ])
-
-        prompt = dedent(f"""
-        Create a comprehensive, advanced-level medical blog post about {self.topic} using these articles.
-        Target audience: Medical professionals and specialists.
-        Writing style: Academic, sophisticated, with precise medical terminology.
-
-        {articles_context}
-
-        Use this exact format:
-
-        # Latest Evidence: {self.topic}
-
-        [3-4 sentence introduction with specific epidemiological data]
-
-        ## 🎯 Key Points
-        - Primary finding with detailed **statistical analysis**
-        - Secondary outcome with **confidence intervals**
-        - Tertiary result with **p-values and clinical significance**
-
-        ## 📚 Background
-        [3-4 paragraphs with pathophysiological mechanisms and current guidelines]
+    def _build_prompt(self) -> str:
+        """User message asking content_agent to write the post from the fetched articles"""
+        # Audience, style, format and requirements all live in
+        # CONTENT_INSTRUCTIONS; the prompt only carries what changes per post
+        return f"Write the blog post about {self.topic}. Source articles:\n\n{self._refs_md}\n\nWord count target: ~1500."
 
-        ## 🔍 Recent Evidence
-        ### Key Findings
-        [Detailed statistical analysis with **methodology and results**]
-
-        ### Clinical Implications
-        [Evidence-based recommendations with levels of evidence]
-
-        ## 💡 Expert Commentary
-        [Critical analysis of methodological strengths/limitations]
-
-        ## 💎 Clinical Pearls
-        - Evidence-based recommendation (Level A)
-        - Key mechanistic insight
-        - Critical implementation consideration
-
-        ## 🎯 Bottom Line
-        [Synthesis of evidence with specific recommendations]
-
-        Requirements:
-        1. Use advanced medical terminology
-        2. Include detailed statistical analyses
-        3. Reference specific guidelines and evidence levels
-        4. Discuss pathophysiological mechanisms
-        5. Critical analysis of methodology
-        6. ~1500 words
-        """)
+    async def _stream_blog_post_async(self) -> AsyncIterator[str]:
+        """Generate formatted medical blog post, yielding text as it is written"""
+        prompt = self._build_prompt()
 
         logger.info("Generating blog post...")
-        response = self.content_agent.run(prompt)
-        content = response.content.strip()
+        head = ""
+        checked_heading = False
+        async for chunk in _stream_agent(self.content_agent, prompt):
+            if not checked_heading:
+                # Hold back the opening text until it can be told apart from a
+                # '# ' title; a chunk may be as short as a single '#'
+                head = (head + chunk).lstrip()
+                if len(head) < 2:
+                    continue
+                if not head.startswith('# '):
+                    yield f"# Latest Evidence: {self.topic}\n\n"
+                checked_heading = True
+                chunk = head
+            yield chunk
 
-        if not content.startswith('# '):
-            content = f"# Latest Evidence: {self.topic}\n\n{content}"
+        if not checked_heading and head:
+            yield f"# Latest Evidence: {self.topic}\n\n"
+            yield head
 
-        return MedicalBlogPost(
-            content=content,
-            word_count=len(content.split()),
-            sources=articles
-        )
+    def _references_footer(self, blog_post: MedicalBlogPost) -> str:
+        """References and word-count block appended after the post body"""
+        return "\n".join([
+            "\n\n---\n### 📚 References",
+            self._refs_md,
+            f"\n---\n*Word count: {blog_post.word_count}*  \nGenerated: {self._run_date_iso}\n",
+        ])
 
-    def run(self, use_cache: bool = True) -> Iterator[RunResponse]:
-        """Execute the blog post generation workflow"""
+    async def _arun(self, use_cache: bool) -> AsyncIterator[RunResponse]:
+        """Async body of run(); streams the post while Groq is still writing it"""
         logger.info(f"Starting blog generation for: {self.topic}")
+        self._run_date_iso = datetime.date.today().isoformat()
 
+        # Both paths emit the post body as run_response event(s) followed by
+        # one workflow_completed event carrying the references footer
         if use_cache:
-            cached_post = self.get_cached_blog_post(self.topic)
+            cached_post = await self.get_cached_blog_post(self.topic)
             if cached_post:
                 logger.info("Using cached post")
+                self._refs_md = _format_references(cached_post.sources)
                 yield RunResponse(
                     run_id=self.run_id,
-                    event=RunEvent.workflow_completed,
+                    event=RunEvent.run_response,
                     content=cached_post.content
                 )
+                yield RunResponse(
+                    run_id=self.run_id,
+                    event=RunEvent.workflow_completed,
+                    content=self._references_footer(cached_post)
+                )
                 return
 
-        articles = self.fetch_recent_articles()
-        logger.info(f"Found {len(articles)} articles")
+        async with self._groq_session():
+            articles = await self._fetch_recent_articles_async()
+            logger.info(f"Found {len(articles)} articles")
+            self._refs_md = _format_references(articles)
 
-        blog_post = self.generate_blog_post(articles)
-        self.add_blog_post_to_cache(self.topic, blog_post)
+            chunks = []
+            async for chunk in self._stream_blog_post_async():
+                chunks.append(chunk)
+                yield RunResponse(
+                    run_id=self.run_id,
+                    event=RunEvent.run_response,
+                    content=chunk
+                )
 
-        final_post = f"""{blog_post.content}
+        content = "".join(chunks).strip()
+        if not content:
+            # Never cache an empty post; later cached runs would replay it
+            raise RuntimeError(f"Groq returned an empty blog post for: {self.topic}")
 
----
-### 📚 References
-{chr(10).join([f'- {article.journal}: [{article.title}]({article.url})' for article in blog_post.sources])}
+        blog_post = MedicalBlogPost(
+            content=content,
+            word_count=_count_words(content),
+            sources=articles
+        )
+        await self.add_blog_post_to_cache(self.topic, blog_post)
 
----
-*Word count: {blog_post.word_count}*  
-Generated: {datetime.datetime.now().strftime("%Y-%m-%d")}
-"""
-        
         yield RunResponse(
             run_id=self.run_id,
             event=RunEvent.workflow_completed,
-            content=final_post
+            content=self._references_footer(blog_post)
         )
 
+    @classmethod
+    async def run_batch(cls, topics: List[str], storage=None) -> Dict[str, str]:
+        """Generate posts for many topics through a single Groq batch job
+
+        Literature searches run concurrently (at most BATCH_CONCURRENCY at a
+        time); the writing prompts are then submitted together to Groq's
+        batch API, which is cheaper and schedules them server-side. Posts are
+        cached under each topic's regular session, so a later interactive run
+        with "Use cached posts" picks them up.
+
+        Returns each generated post as Markdown, followed by the same
+        References footer an interactive run appends.
+        """
+        generators = {
+            topic: cls(topic=topic, session_id=_session_id(topic), storage=storage)
+            for topic in dict.fromkeys(topics)
+        }
+        for generator in generators.values():
+            # Keep whatever the topic's session already holds when writing back
+            generator.read_from_storage()
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+        # Searches run on worker threads (see _call_agent); the default pool
+        # can be as small as 5, so size it for every concurrent topic's
+        # primary and speculative search
+        asyncio.get_running_loop().set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(max_workers=2 * BATCH_CONCURRENCY)
+        )
+
+        async def fetch(generator: "MedicalBlogGenerator") -> List[MedicalArticle]:
+            async with semaphore, generator._groq_session():
+                articles = await generator._fetch_recent_articles_async()
+            generator._refs_md = _format_references(articles)
+            return articles
+
+        logger.info(f"Searching medical literature for {len(generators)} topics...")
+        found = await asyncio.gather(*(fetch(generator) for generator in generators.values()))
+        articles = dict(zip(generators, found))
+
+        lines = []
+        for topic, generator in generators.items():
+            messages = []
+            system_message = generator.content_agent.get_system_message()
+            if system_message is not None:
+                messages.append({"role": "system", "content": system_message.content})
+            messages.append({"role": "user", "content": generator._build_prompt()})
+            lines.append(json.dumps({
+                "custom_id": topic,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": generator.content_agent.model.id,
+                    "messages": messages,
+                    "max_tokens": generator.content_agent.model.max_tokens,
+                },
+            }))
+
+        async with _groq_http_client() as http_client:
+            client = AsyncGroq(api_key=GROQ_API_KEY, http_client=http_client, max_retries=0)
+            batch_file = await with_backoff(lambda: client.files.create(
+                file=("medical_blog_batch.jsonl", "\n".join(lines).encode()),
+                purpose="batch",
+            ))
+            batch = await with_backoff(lambda: client.batches.create(
+                completion_window="24h",
+                endpoint="/v1/chat/completions",
+                input_file_id=batch_file.id,
+            ))
+            logger.info(f"Submitted Groq batch {batch.id}")
+
+            delay = BATCH_POLL_INTERVAL
+            while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, BATCH_POLL_CAP)
+                batch = await with_backoff(lambda: client.batches.retrieve(batch.id))
+
+            if batch.status != "completed":
+                raise RuntimeError(f"Groq batch {batch.id} ended with status {batch.status}")
+            # Successful requests land in the output file, failed ones only in
+            # the error file
+            output = ""
+            if batch.output_file_id:
+                output = await (await with_backoff(lambda: client.files.content(batch.output_file_id))).text()
+            if batch.error_file_id:
+                errors = await (await with_backoff(lambda: client.files.content(batch.error_file_id))).text()
+                for line in errors.splitlines():
+                    if line.strip():
+                        result = json.loads(line)
+                        logger.error(f"Batch request failed for {result.get('custom_id')}: {result.get('error')}")
+
+        posts = {}
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            topic = result.get("custom_id")
+            response = result.get("response") or {}
+            if topic not in generators or response.get("status_code") != 200:
+                logger.error(f"Batch request failed for {topic}: {result.get('error')}")
+                continue
+
+            content = response["body"]["choices"][0]["message"]["content"].strip()
+            if not content.startswith('# '):
+                content = f"# Latest Evidence: {topic}\n\n{content}"
+
+            blog_post = MedicalBlogPost(
+                content=content,
+                word_count=_count_words(content),
+                sources=articles[topic]
+            )
+            generator = generators[topic]
+            await generator.add_blog_post_to_cache(topic, blog_post)
+            if generator.storage is not None:
+                generator.write_to_storage()
+            posts[topic] = blog_post.content + generator._references_footer(blog_post)
+
+        for topic in generators.keys() - posts.keys():
+            logger.error(f"No blog post generated for: {topic}")
+
+        return posts
+
+    def run(self, use_cache: bool = True) -> Iterator[RunResponse]:
+        """Execute the blog post generation workflow"""
+        yield from _iter_async(self._arun(use_cache))
+
 def main():
     st.set_page_config(
         page_title="Medical Blog Generator",
@@ -366,32 +981,64 @@ def main():
     if st.button("Generate Blog Post", type="primary"):
         if not topic:
             st.error("Please enter a medical topic")
+        elif not GROQ_API_KEY or not EXA_API_KEY:
+            st.error("Set the GROQ_API_KEY and EXA_API_KEY environment variables")
         else:
             try:
-                with st.spinner("Generating blog post..."):
-                    url_safe_topic = topic.lower().replace(" ", "-")
-                    
+                with st.spinner("Searching medical literature..."):
                     blog_generator = MedicalBlogGenerator(
                         topic=topic,
-                        session_id=f"medical-blog-{url_safe_topic}",
-                        storage=SqlWorkflowStorage(
-                            table_name="medical_blog_workflows",
-                            db_file="tmp/workflows.db",
-                        ),
+                        session_id=_session_id(topic),
+                        storage=_workflow_storage(),
                     )
                     
-                    for response in blog_generator.run(use_cache=use_cache):
-                        st.markdown(response.content)
-                        
-                        # Add download button after generation
+                    responses = blog_generator.run(use_cache=use_cache)
+                    # Block under the spinner until the first chunk arrives
+                    first_response = next(responses, None)
+
+                if first_response is not None:
+                    blog_post = st.write_stream(
+                        response.content for response in itertools.chain([first_response], responses)
+                    )
+
+                    # Add download button after generation
+                    st.download_button(
+                        label="Download as Markdown",
+                        data=blog_post,
+                        file_name=f"medical_blog_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.md",
+                        mime="text/markdown"
+                    )
+            except Exception as e:
+                st.error(f"Error generating blog post: {str(e)}")
+
+    # Bulk generation from a CSV of topics
+    with st.expander("Bulk generation"):
+        st.markdown("Upload a CSV with one topic per row (first column). "
+                    "Posts are written through Groq's batch API, which can take a while.")
+        topics_file = st.file_uploader("Topics CSV", type="csv")
+        if st.button("Submit batch", disabled=topics_file is None):
+            topics = _read_topics_csv(topics_file.getvalue())
+            if not topics:
+                st.error("The CSV contains no topics")
+            elif not GROQ_API_KEY or not EXA_API_KEY:
+                st.error("Set the GROQ_API_KEY and EXA_API_KEY environment variables")
+            else:
+                try:
+                    with st.spinner(f"Generating {len(topics)} blog posts..."):
+                        posts = _run_sync(MedicalBlogGenerator.run_batch(topics, storage=_workflow_storage()))
+                    missing = [topic for topic in dict.fromkeys(topics) if topic not in posts]
+                    st.success(f"Generated {len(posts)} of {len(missing) + len(posts)} posts")
+                    if missing:
+                        st.warning("No post for: " + ", ".join(missing))
+                    if posts:
                         st.download_button(
-                            label="Download as Markdown",
-                            data=response.content,
-                            file_name=f"medical_blog_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.md",
+                            label="Download all as Markdown",
+                            data="\n\n---\n\n".join(posts.values()),
+                            file_name=f"medical_blogs_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.md",
                             mime="text/markdown"
                         )
-            except Exception as e:
-                st.error(f"Error generating blog post: {str(e)}")
+                except Exception as e:
+                    st.error(f"Error generating blog posts: {str(e)}")
 
     # Footer
     st.markdown("---")